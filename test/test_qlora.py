@@ -17,6 +17,20 @@ try:
 except ImportError:
     print("Could not import bitsandbytes")
 
+triton_available = False
+try:
+    import triton
+
+    from transformer_nuggets.quant.dequant_kernel import (
+        dequant_nf4_tensor,
+        linear_nf4_triton,
+        silu_mul,
+    )
+
+    triton_available = True
+except ImportError:
+    print("Could not import triton")
+
 
 @pytest.mark.parametrize(
     "inpt_size, block_size, scaler_block_size", [(16384, 64, 256), (256, 16, 16), (1024, 32, 32)]
@@ -154,6 +168,46 @@ def test_bitsandbytes_mlp_parity(embed_dim, compile):
     assert bnb_difference.max() < (0.5 * embed_dim) ** 2
 
 
+@unittest.skipIf(not triton_available, "Triton not available")
+@pytest.mark.parametrize("embed_dim", [256, 4096, 5120])
+def test_triton_dequant_vs_eager(embed_dim: int):
+    torch.manual_seed(0)
+    device = "cuda:0"
+    input_weight = qlora.build_input_weight(embed_dim, device)
+    nugs_qlora = NF4Tensor.from_tensor(input_weight)
+    eager_weight = nugs_qlora.get_original_weight()
+    triton_weight = dequant_nf4_tensor(nugs_qlora)
+    torch.testing.assert_close(triton_weight, eager_weight)
+
+
+@unittest.skipIf(not triton_available, "Triton not available")
+@pytest.mark.parametrize("embed_dim", [256, 4096])
+@pytest.mark.parametrize("requires_grad", [True, False])
+def test_triton_linear_vs_eager(embed_dim: int, requires_grad: bool):
+    torch.manual_seed(0)
+    device = "cuda:0"
+    input_weight = qlora.build_input_weight(embed_dim, device)
+    sample_input = qlora.get_sample_inputs(8, 128, embed_dim, device, requires_grad=requires_grad)
+    nugs_qlora = NF4Tensor.from_tensor(input_weight)
+    eager_result = linear_nf4(sample_input, nugs_qlora)
+    triton_result = linear_nf4_triton(sample_input, nugs_qlora)
+    torch.testing.assert_close(triton_result, eager_result)
+    if requires_grad:
+        triton_result.sum().backward()
+
+
+@unittest.skipIf(not triton_available, "Triton not available")
+@pytest.mark.parametrize("numel", [1024, 16384 + 16])
+def test_triton_silu_mul_vs_eager(numel: int):
+    torch.manual_seed(0)
+    device = "cuda:0"
+    gate = torch.randn(numel, device=device, dtype=torch.bfloat16)
+    up = torch.randn(numel, device=device, dtype=torch.bfloat16)
+    eager_result = F.silu(gate) * up
+    triton_result = silu_mul(gate, up)
+    torch.testing.assert_close(triton_result, eager_result)
+
+
 @pytest.mark.parametrize("embed_dim", [256, 4096])
 @pytest.mark.parametrize("compile", [True, False])
 @pytest.mark.parametrize("r", [1, 2])
@@ -175,3 +229,25 @@ def test_qlora_linear(embed_dim: int, compile: bool, r: int, dropout: float, run
         out.sum().backward()
         assert nugs_qlora_linear.lora_A.grad is not None
         assert nugs_qlora_linear.lora_B.grad is not None
+
+
+@pytest.mark.parametrize("embed_dim", [256, 4096])
+@pytest.mark.parametrize("r", [1, 2])
+def test_qlora_linear_eval_merge(embed_dim: int, r: int):
+    torch.manual_seed(0)
+    device = "cuda:0"
+    weight = qlora.get_mlp_weights(embed_dim, device)[0]
+    n_hidden = weight.size(0)
+    qlora_linear = qlora.QloraLinear(embed_dim, n_hidden, weight, r)
+    # lora_B is zeros after init so give the LoRA path something to contribute
+    with torch.no_grad():
+        qlora_linear.lora_B.normal_(0, 1)
+    sample_input = qlora.get_sample_inputs(8, 128, embed_dim, device)
+    train_result = qlora_linear(sample_input)
+    qlora_linear.eval()
+    # Inference runs under no_grad; this also exercises the zero-LoRA skip
+    # logic, which must see that lora_B was mutated to nonzero above
+    with torch.no_grad():
+        eval_result = qlora_linear(sample_input)
+    # The merged path changes the order of the bf16 accumulations
+    torch.testing.assert_close(eval_result, train_result, atol=2e-1, rtol=2e-2)
@@ -148,6 +148,8 @@ class Transformer(nn.Module):
                     torch.nn.init.zeros_(module.bias)
             elif isinstance(module, nn.Embedding):
                 torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
+            elif isinstance(module, RMSNorm):
+                torch.nn.init.ones_(module.weight)
 
         self.apply(_init_weights)
 
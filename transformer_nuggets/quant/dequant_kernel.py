@@ -0,0 +1,173 @@
+# Triton kernel for dequantizing NF4Tensors back to bfloat16
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import transformer_nuggets.quant.qlora as qlora
+
+import triton
+import triton.language as tl
+from transformer_nuggets.quant.qlora import maybe_compile_mlp_forward, NF4Tensor
+
+
+@triton.jit
+def dequant_nf4_kernel(
+    inpt_ptr,
+    output_ptr,
+    quantized_scalers_ptr,
+    quantization_factor_ptr,
+    scaler_mean_ptr,
+    nf4_lut_ptr,
+    scaler_block_size: tl.constexpr,
+    block_size: tl.constexpr,
+    n_bytes: int,
+    XBLOCK: tl.constexpr,
+):
+    """Dequantize a packed nf4 tensor in a single launch: unpack the nibbles,
+    look up their nf4 values, dequantize the double-quantized scaler for the
+    block, and store the scaled bf16 elements."""
+    offset = tl.program_id(0) * XBLOCK
+    index = offset + tl.arange(0, XBLOCK)[:]
+    mask = index < n_bytes
+    packed = tl.load(inpt_ptr + index, mask=mask)
+    # Shift elements down 4 and select out the bottom 4 bits
+    first = packed >> 4
+    second = packed & 0b1111
+    # Branchless LUT gathers; evict_last keeps the 16 entries resident in cache
+    # across the whole grid
+    first_val = tl.load(nf4_lut_ptr + first, mask=mask, eviction_policy="evict_last")
+    second_val = tl.load(nf4_lut_ptr + second, mask=mask, eviction_policy="evict_last")
+    # Each byte holds two elements so block_size // 2 bytes share one scaler
+    block_index = index // (block_size // 2)
+    quantized_scaler = tl.load(quantized_scalers_ptr + block_index, mask=mask)
+    factor = tl.load(quantization_factor_ptr + block_index // scaler_block_size, mask=mask)
+    scaler_mean = tl.load(scaler_mean_ptr)
+    scaler = quantized_scaler.to(tl.bfloat16) / factor + scaler_mean
+    # Interleave the two nibble streams in registers and write one contiguous
+    # 2 * XBLOCK span instead of two stride-2 stores
+    values = tl.interleave(first_val * scaler, second_val * scaler)
+    out_index = offset * 2 + tl.arange(0, 2 * XBLOCK)[:]
+    out_mask = out_index < 2 * n_bytes
+    tl.store(output_ptr + out_index, values, mask=out_mask)
+
+
+def dequant_nf4_tensor(weight: NF4Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Dequantize an NF4Tensor back to bfloat16 with one fused kernel.
+
+    The eager get_original_weight launches separate kernels for the scaler
+    dequant, the LUT gather, the scaling, and the interleave; this streams the
+    packed bytes through registers once and writes the bf16 output once.
+
+    Args:
+        weight: NF4Tensor to dequantize
+        out: Preallocated flat bf16 tensor to write into. Passing a stable
+            buffer keeps the dequant allocation-free so cuda graph replay can
+            capture it.
+    """
+    assert isinstance(weight, NF4Tensor), "Expected an NF4Tensor"
+    assert weight.quantized_data.is_cuda, "NF4 dequant kernel requires cuda tensors"
+    numel = weight.original_shape.numel()
+    if out is None:
+        out = torch.empty(numel, dtype=torch.bfloat16, device=weight.device)
+    else:
+        assert out.numel() == numel and out.dtype == torch.bfloat16
+    n_bytes = numel // 2
+    XBLOCK = 512
+    grid = (triton.cdiv(n_bytes, XBLOCK),)
+    dequant_nf4_kernel[grid](
+        weight.quantized_data,
+        out,
+        weight.quantized_scalers,
+        weight.quantization_factor,
+        weight.scaler_mean,
+        weight.nf4,
+        weight.scaler_block_size,
+        weight.block_size,
+        n_bytes,
+        XBLOCK=XBLOCK,
+    )
+    return out.view(weight.original_shape)
+
+
+@triton.jit
+def silu_mul_kernel(gate_ptr, up_ptr, output_ptr, numel, XBLOCK: tl.constexpr):
+    """Compute silu(gate) * up in one pass instead of materializing silu(gate)."""
+    index = tl.program_id(0) * XBLOCK + tl.arange(0, XBLOCK)[:]
+    mask = index < numel
+    gate = tl.load(gate_ptr + index, mask=mask).to(tl.float32)
+    up = tl.load(up_ptr + index, mask=mask).to(tl.float32)
+    result = gate * tl.sigmoid(gate) * up
+    tl.store(output_ptr + index, result.to(output_ptr.dtype.element_ty), mask=mask)
+
+
+def silu_mul(gate: torch.Tensor, up: torch.Tensor) -> torch.Tensor:
+    """Fused SwiGLU gate: silu(gate) * up with a single read of each input.
+
+    The eager F.silu(y1) * y3 writes the silu intermediate to HBM and reads it
+    back for the multiply; fusing the two saves that round trip.
+    """
+    assert gate.shape == up.shape, "Expected gate and up to have the same shape"
+    gate = gate.contiguous()
+    up = up.contiguous()
+    out = torch.empty_like(gate)
+    numel = gate.numel()
+    XBLOCK = 1024
+    grid = (triton.cdiv(numel, XBLOCK),)
+    silu_mul_kernel[grid](gate, up, out, numel, XBLOCK=XBLOCK)
+    return out
+
+
+class LinearNF4Triton(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input: torch.Tensor, weight: NF4Tensor):
+        if input.requires_grad:
+            dequantized_weight = dequant_nf4_tensor(weight)
+            if qlora.cache_dequant_for_backward:
+                # Keep the bf16 weight alive so backward skips the re-dequant
+                ctx.save_for_backward(dequantized_weight)
+            else:
+                ctx.nf4_weight = weight
+        else:
+            # Inference path: reuse a per-weight output buffer so replays are
+            # allocation free and safe to capture in a cuda graph
+            if getattr(weight, "_dequant_out", None) is None:
+                weight._dequant_out = torch.empty(
+                    weight.original_shape.numel(), dtype=torch.bfloat16, device=weight.device
+                )
+            dequantized_weight = dequant_nf4_tensor(weight, out=weight._dequant_out)
+        return F.linear(input, dequantized_weight)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        saved = ctx.saved_tensors
+        if saved:
+            (dequantized_weight,) = saved
+        else:
+            dequantized_weight = dequant_nf4_tensor(ctx.nf4_weight)
+        return grad_output @ dequantized_weight, None
+
+
+def linear_nf4_triton(input: torch.Tensor, weight: NF4Tensor) -> torch.Tensor:
+    return LinearNF4Triton.apply(input, weight)
+
+
+class NF4MLPTriton(nn.Module):
+    def __init__(self, weight1, weight2, weight3) -> None:
+        super().__init__()
+        self.w1 = NF4Tensor.from_tensor(weight1)
+        self.w2 = NF4Tensor.from_tensor(weight2)
+        self.w3 = NF4Tensor.from_tensor(weight3)
+        maybe_compile_mlp_forward(self)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        gate = linear_nf4_triton(x, self.w1)
+        up = linear_nf4_triton(x, self.w2)
+        if gate.requires_grad:
+            # The fused kernel has no backward, fall back to the eager gate
+            x = F.silu(gate) * up
+        else:
+            x = silu_mul(gate, up)
+        x = linear_nf4_triton(x, self.w3)
+        return x
@@ -1,7 +1,9 @@
+import functools
 import logging
 import math
+import os
 from dataclasses import dataclass, field
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -12,6 +14,59 @@ logging.basicConfig(level=logging.INFO)
 
 bnb_available = False
 
+# When True the nf4 linear autograd functions keep the dequantized bf16 weight
+# alive between forward and backward, trading one full weight of memory per
+# layer for skipping the backward re-dequant. Off by default since QLoRA runs
+# are usually memory bound on activations.
+cache_dequant_for_backward = False
+
+
+# Built once at import time; per (device, dtype) copies come out of the caches below
+_NF4_CPU = torch.tensor(
+    [
+        -1.0000,
+        -0.6962,
+        -0.5251,
+        -0.3949,
+        -0.2844,
+        -0.1848,
+        -0.0911,
+        0.0000,
+        0.0796,
+        0.1609,
+        0.2461,
+        0.3379,
+        0.4407,
+        0.5626,
+        0.7230,
+        1.0000,
+    ],
+    dtype=torch.float32,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _nf4(device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Cached per (device, dtype) nf4 lookup table, so quantizing every layer of a
+    model does not re-allocate and re-transfer the same 16 values per weight."""
+    return _NF4_CPU.to(device=device, dtype=dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _nf4_midpoints(device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Cached midpoints between adjacent nf4 values, used for nearest bucketing."""
+    nf4 = _nf4(device, dtype)
+    return (nf4[:-1] + nf4[1:]) / 2
+
+
+@functools.lru_cache(maxsize=None)
+def _nf4_byte_lut(device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Cached (256, 2) table mapping a packed byte to its pair of nf4 values, so
+    dequantization is a single gather per byte instead of two nibble gathers."""
+    nf4 = _nf4(device, dtype)
+    byte_values = torch.arange(256, device=device)
+    return torch.stack([nf4[byte_values >> 4], nf4[byte_values & 0b1111]], dim=1)
+
 
 def get_block_absmax(inpt_tensor: torch.Tensor, block_size: int) -> torch.Tensor:
     """Iterate through a flattened tensor getting the absmax scalers for each block
@@ -35,6 +90,26 @@ def get_block_absmax(inpt_tensor: torch.Tensor, block_size: int) -> torch.Tensor
     return block_scalers
 
 
+@torch.compile(dynamic=False)
+def _quantize_pack(
+    flattened_tensor: torch.Tensor, n_blocks: int, block_size: int, nf4_midpoints: torch.Tensor
+) -> torch.Tensor:
+    """Scale each block by its absmax, quantize to nf4 indices, and pack pairs of
+    indices into uint8 values. Compiled with static shapes so inductor can fuse
+    the scale, bucketize, and packing into a couple of kernels instead of ~6
+    separate launches with materialized intermediates.
+    """
+    blocks = flattened_tensor.view(n_blocks, block_size)
+    scalers = blocks.abs().max(dim=1).values
+    scaled_blocks = blocks / scalers.unsqueeze(-1)
+    quantized_blocks = torch.bucketize(scaled_blocks.flatten().contiguous(), nf4_midpoints)
+    # Pair up the codes via a (numel // 2, 2) view rather than two stride-2 slices,
+    # so the shift and or read each code once from a contiguous layout
+    pairs = quantized_blocks.view(-1, 2)
+    combined_blocks = torch.bitwise_or(pairs[:, 0] << 4, pairs[:, 1])
+    return combined_blocks.to(torch.uint8)
+
+
 class NF4Tensor:
     """NF4Tensor class for converting a weight to the QLoRA NF4 format"""
 
@@ -52,29 +127,8 @@ class NF4Tensor:
         ), "Input tensor must be divisible by block size"
         assert inpt_tensor.dtype == torch.bfloat16, "Input tensor must be bfloat16"
         device = inpt_tensor.device
-        # Cache the tensor on the class def
-        nf4 = torch.tensor(
-            [
-                -1.0000,
-                -0.6962,
-                -0.5251,
-                -0.3949,
-                -0.2844,
-                -0.1848,
-                -0.0911,
-                0.0000,
-                0.0796,
-                0.1609,
-                0.2461,
-                0.3379,
-                0.4407,
-                0.5626,
-                0.7230,
-                1.0000,
-            ],
-            device=device,
-            dtype=torch.bfloat16,
-        )
+        # Cached per device so repeated per-layer quantization does not re-allocate it
+        nf4 = _nf4(device, inpt_tensor.dtype)
         n_blocks = inpt_tensor.numel() // block_size
         # Double quantization
         (
@@ -119,6 +173,9 @@ class NF4Tensor:
         self.quantized_data = quantized_data
         self.original_shape = original_shape
         self.nf4 = nf4
+        # Resolved from the lru cache here so the compiled dequant path only sees a
+        # plain attribute access
+        self.byte_lut = _nf4_byte_lut(self.device, nf4.dtype)
 
     @staticmethod
     def double_quantize_scalers(
@@ -158,18 +215,16 @@ class NF4Tensor:
         scaler_blocks = scalers_1.view(n_scaler_blocks, scaler_block_size)
 
         scaler_absmax = get_block_absmax(scalers_1, scaler_block_size)
-        scaler_absmax = scaler_absmax.unsqueeze(-1).expand(n_scaler_blocks, scaler_block_size)
 
+        # Keep the quantization factor at one entry per scaler block and broadcast it
+        # over the block. This leaves both the int8 scalers and the bf16 factors as
+        # contiguous structure-of-arrays tensors, so dequantization is a single
+        # vectorized multiply.
         quantization_factor = 256 / (2 * scaler_absmax)
-        quantized_scaler_blocks = scaler_blocks * quantization_factor
+        quantized_scaler_blocks = scaler_blocks * quantization_factor.unsqueeze(-1)
         quantized_scaler_blocks = quantized_scaler_blocks.round()
         quantized_scaler_blocks = quantized_scaler_blocks.clamp(-128, 127)
 
-        # This is needed to make sure that quantization_factor remains a repeated view of n_scaler_blocks
-        # For some reason the 127/scaler_absmax realizes n_scaler entries when only n_scaler_blocks are needed
-        # The following will grab the first entry for the n_scaler_blocks which is the same across the scaler_block_size
-        quantization_factor = quantization_factor[:, 0]
-
         return (
             quantized_scaler_blocks.flatten().to(torch.int8),
             quantization_factor.view(n_scaler_blocks),
@@ -210,15 +265,7 @@ class NF4Tensor:
         assert (
             numel % 2 == 0
         ), "Number of elements must be even just to not have to think about the end"
-        # Reshape the flattened tensor into blocks of size self.block_size
-        blocks = flattened_tensor.view(n_blocks, block_size)
-
-        # Scale the blocks
-        scalers = get_block_absmax(inpt_tensor.flatten(), block_size)
-        scales = scalers.unsqueeze(-1).expand(n_blocks, block_size)
-        scaled_blocks = blocks / scales
-
-        # Returns a flattened tensor with each element quantized to nf4 index
+        # Scale, quantize, and pack in a single fused kernel.
         # The weird behavior comes here with how qlora vs bnb break nf4 ties.
         # Since we ust torch.min(nf4 - inpt/scale) we will always pick the smallest index
         # While bnb appears to be pick the larger index when breaking ties
@@ -226,50 +273,34 @@ class NF4Tensor:
         # Is not consistent with torch.round. Example: input 1.1016 with abs max
         # scale of 2.2821 will get mapped to 1.25 while mine will get mapped to 0.9570
         # The difference for mine is 0.1445 and for bnb 0.1484
-        quantized_blocks = NF4Tensor.quantize_tensor_nearest(scaled_blocks.flatten(), nf4)
-
-        # Combine the quantized elements into uint8 values
-        combined_blocks = quantized_blocks[::2] << 4 | quantized_blocks[1::2]
-
-        return combined_blocks.to(torch.uint8)
+        nf4_midpoints = _nf4_midpoints(nf4.device, nf4.dtype)
+        return _quantize_pack(flattened_tensor, n_blocks, block_size, nf4_midpoints)
 
     def get_original_weight(self) -> torch.Tensor:
         """Get the original weight from the normalized float weight format"""
         # since we are using uint8 we will decode 2 entries per byte
-        # Shift elements down 4 and select out the bottom 4 bits
-        first_elements = (self.quantized_data >> 4).to(torch.long)
-        second_elements = (self.quantized_data & 0b1111).to(torch.long)
-
-        # Dequantize every element
-        dequantized_first = self.dequantize(first_elements, self.nf4)
-        dequantized_second = self.dequantize(second_elements, self.nf4)
+        # One gather through the 256-entry byte LUT yields both nibbles at once,
+        # already in interleaved order after the reshape
+        dequantized_pairs = self.byte_lut[self.quantized_data.to(torch.long)]
 
-        # Build up matrix of scalers repeated for each element in the block
-        # Since first and second elements make up a full block, so
-        # we expand out to half the size of the full block
         scalers = self.dequantize_scalers(
             self.quantized_scalers, self.quantization_factor, self.scaler_block_size
         )
-        repeated = scalers.unsqueeze(-1).expand(scalers.size(0), self.block_size // 2)
-
-        scaled_first = dequantized_first * repeated.flatten()
-        scaled_second = dequantized_second * repeated.flatten()
-
-        # Flip them to be vertical and them stack them together horizontally
-        # Upon flattening this will interleave the elements
-        scaled_first = scaled_first.unsqueeze(-1).transpose(0, 1)
-        scaled_second = scaled_second.unsqueeze(-1).transpose(0, 1)
-        return torch.stack([scaled_first, scaled_second], dim=-1).reshape(self.original_shape)
+        original_weight = dequantized_pairs.view(
+            self.n_blocks, self.block_size // 2, 2
+        ) * scalers.view(-1, 1, 1)
+        return original_weight.reshape(self.original_shape)
 
     @staticmethod
     def quantize_tensor_nearest(value: torch.float16, nf4: torch.Tensor) -> torch.Tensor:
         """Quantize a float16 tensor to nf4 format to nearest and not rounded up"""
-        value = value.unsqueeze(-1)  # (numel, 1)
-        # Compare the value tensor with the nf4 tensor element-wise
-        diff = (value - nf4).abs()
-        # BnB appears to break ties by choosing the larger nf4 value
-        closest_nf4 = diff.min(dim=-1).indices
-        return closest_nf4
+        # Bucketizing against the midpoints between adjacent nf4 values gives the
+        # nearest entry with O(numel) memory traffic instead of materializing the
+        # (numel, 16) broadcasted compare. Ties land on the smaller index, matching
+        # the old diff.min behavior. BnB appears to break ties by choosing the
+        # larger nf4 value
+        midpoints = (nf4[:-1] + nf4[1:]) / 2
+        return torch.bucketize(value.contiguous(), midpoints)
 
     @staticmethod
     def dequantize(value: torch.Tensor, nf4: torch.Tensor) -> torch.Tensor:
@@ -301,13 +332,22 @@ class NF4Tensor:
 class LinearNF4(torch.autograd.Function):
     @staticmethod
     def forward(ctx, input: torch.Tensor, weight: NF4Tensor):
-        ctx.nf4_weight = weight
-        return F.linear(input, weight.get_original_weight())
+        original_weight = weight.get_original_weight()
+        if cache_dequant_for_backward:
+            ctx.save_for_backward(original_weight)
+        else:
+            # Keep only the packed weight alive; backward re-dequantizes
+            ctx.nf4_weight = weight
+        return F.linear(input, original_weight)
 
     @staticmethod
     def backward(ctx, grad_output):
-        weight: NF4Tensor = ctx.nf4_weight
-        return grad_output @ weight.get_original_weight(), None
+        saved = ctx.saved_tensors
+        if saved:
+            (original_weight,) = saved
+        else:
+            original_weight = ctx.nf4_weight.get_original_weight()
+        return grad_output @ original_weight, None
 
 
 def linear_nf4(input: torch.Tensor, weight: NF4Tensor) -> torch.Tensor:
@@ -321,24 +361,33 @@ def build_input_weight(embed_dim: int, device: torch.device):
     return input_weight
 
 
+@functools.cache
+def _bnb():
+    """Import bitsandbytes once; swap loops call this per layer so keep it to a
+    cached attribute lookup instead of a globals() probe and import-lock hit."""
+    import bitsandbytes as bnb
+
+    return bnb
+
+
 def build_bitsandbytes_linear(input_weight: torch.Tensor, device: torch.device):
-    global bnb
-    if "bnb" not in globals():
-        import bitsandbytes as bnb
+    bnb = _bnb()
     param = bnb.nn.Params4bit(input_weight, requires_grad=False, quant_type="nf4").cuda(device)
     bnb_linear = bnb.nn.LinearNF4(input_weight.size(0), input_weight.size(1), bias=False)
     bnb_linear.weight = param
-    bnb_linear.to(device)
+    # param is already quantized on device by the .cuda() above; a trailing
+    # .to(device) would walk and move the module's tensors again for nothing
     return bnb_linear
 
 
 def get_sample_inputs(
     bsz: int, seqlen: int, embed_dim: int, device: torch.device, requires_grad: bool = False
 ) -> torch.Tensor:
-    sample_input = torch.rand(
-        bsz, seqlen, embed_dim, device=device, dtype=torch.bfloat16, requires_grad=requires_grad
-    )
-    sample_input = sample_input.view(bsz * seqlen, embed_dim)
+    # Allocate the flattened shape directly and fill in place so the bf16 RNG
+    # runs as one kernel with no fp32 staging or reshape afterwards
+    sample_input = torch.empty(bsz * seqlen, embed_dim, device=device, dtype=torch.bfloat16)
+    sample_input.uniform_(0, 1)
+    sample_input.requires_grad_(requires_grad)
     return sample_input
 
 
@@ -378,12 +427,24 @@ class MLP(nn.Module):
         return x
 
 
+def maybe_compile_mlp_forward(module: nn.Module) -> None:
+    """Compile an MLP forward when NUGGETS_COMPILE_MLP=1 is set.
+
+    The MLP forwards are pure op compositions so torch.compile can fuse the
+    silu/mul elementwise tail and elide launch overhead with cuda graphs. Opt-in
+    via env flag so the default path stays eager and debuggable.
+    """
+    if os.getenv("NUGGETS_COMPILE_MLP", "0") == "1":
+        module.forward = torch.compile(module.forward, dynamic=False, mode="reduce-overhead")
+
+
 class NF4MLP(nn.Module):
     def __init__(self, weight1, weight2, weight3) -> None:
         super().__init__()
         self.w1 = NF4Tensor.from_tensor(weight1)
         self.w2 = NF4Tensor.from_tensor(weight2)
         self.w3 = NF4Tensor.from_tensor(weight3)
+        maybe_compile_mlp_forward(self)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = F.silu(linear_nf4(x, self.w1)) * linear_nf4(x, self.w2)
@@ -420,30 +481,84 @@ class QloraLinear(nn.Module):
         self.lora_alpha = lora_alpha
         self.in_features = in_features
         self.out_features = out_features
-        self.lora_A = nn.Parameter(weight.new_zeros((r, in_features)))
-        self.lora_B = nn.Parameter(weight.new_zeros((out_features, r)))
+        # Stored pre-transposed so the forward is two plain matmuls with no
+        # stride games for the GEMM to work around
+        self.lora_A = nn.Parameter(weight.new_zeros((in_features, r)))
+        self.lora_B = nn.Parameter(weight.new_zeros((r, out_features)))
         self.scaling = self.lora_alpha / self.r
 
-        # Optional dropout
-        if lora_dropout > 0.0:
-            self.lora_dropout = nn.Dropout(p=lora_dropout)
-        else:
-            self.lora_dropout = lambda x: x
+        # Optional dropout; Identity keeps the no-dropout case a C-dispatched
+        # no-op that torch.compile traces through cleanly
+        self.lora_dropout = nn.Dropout(p=lora_dropout) if lora_dropout > 0.0 else nn.Identity()
 
         self.reset_parameters()
+        # Lazily built dequant(W) + scaling * B @ A used for eval-mode forwards
+        self._merged_weight: Optional[torch.Tensor] = None
+        # lora_B starts at zero so the side path is an exact no-op until the
+        # first optimizer step. None means unknown: the next skip-eligible
+        # forward checks the parameter itself, so weights mutated or loaded
+        # outside the grad hook (e.g. dcp.load copies in place) stay correct
+        self._lora_is_zero: Optional[bool] = None
+        self.lora_B.register_hook(self._mark_lora_nonzero)
 
     def reset_parameters(self):
-        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        # Init through the transposed view so the fan matches the (r, in) layout
+        nn.init.kaiming_uniform_(self.lora_A.t(), a=math.sqrt(5))
         nn.init.zeros_(self.lora_B)
+        self._merged_weight = None
+
+    def _mark_lora_nonzero(self, grad: torch.Tensor) -> torch.Tensor:
+        self._lora_is_zero = False
+        return grad
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # The loaded lora weights may or may not be zero, re-check lazily and
+        # drop any merged weight built from the pre-load parameters
+        self._lora_is_zero = None
+        self._merged_weight = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def train(self, mode: bool = True) -> "QloraLinear":
+        # The LoRA params change between mode switches, drop the merged weight
+        # and re-verify the zero flag on the next skip-eligible forward
+        self._merged_weight = None
+        self._lora_is_zero = None
+        return super().train(mode)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not torch.is_grad_enabled() and self._lora_is_zero is not False:
+            if self._lora_is_zero is None:
+                self._lora_is_zero = not bool(self.lora_B.any())
+            if self._lora_is_zero:
+                # Pre-first-step warmup/eval: skip the two LoRA GEMMs and the
+                # add since they contribute exactly zero
+                return linear_nf4(x, self.weight)
+        if not self.training and not torch.is_grad_enabled():
+            # LoRA merges into the base weight at inference time, so eval costs a
+            # single GEMM instead of the three-matmul LoRA side path. Grad-enabled
+            # eval forwards fall through so lora_A/lora_B still receive grads
+            if self._merged_weight is None:
+                with torch.no_grad():
+                    delta = (self.lora_A @ self.lora_B).t() * self.scaling
+                    self._merged_weight = self.weight.get_original_weight() + delta
+            return F.linear(x, self._merged_weight)
         result = linear_nf4(x, self.weight)
-        result2 = (
-            result
-            + (self.lora_dropout(x) @ self.lora_A.transpose(0, 1) @ self.lora_B.transpose(0, 1))
-            * self.scaling
+        # The LoRA matmuls are bandwidth bound on x; keep A/B in the activation
+        # dtype so nothing silently upcasts the side path to fp32
+        lora_A, lora_B = self.lora_A, self.lora_B
+        if lora_A.dtype != x.dtype:
+            lora_A = lora_A.to(x.dtype)
+            lora_B = lora_B.to(x.dtype)
+        # addmm folds the scaling and the residual add into the second GEMM's
+        # epilogue, replacing a separate scalar-mul kernel and add kernel
+        hidden = self.lora_dropout(x) @ lora_A
+        result2 = torch.addmm(
+            result.view(-1, self.out_features),
+            hidden.view(-1, self.r),
+            lora_B,
+            alpha=self.scaling,
         )
-        return result2
+        return result2.view_as(result)
 
 
 @dataclass
@@ -479,6 +594,7 @@ class QloraMLP(nn.Module):
         self.qlora_w3 = QloraLinear(
             weight3.shape[1], weight3.shape[0], weight3, lora_r, lora_alpha, lora_dropout
         )
+        maybe_compile_mlp_forward(self)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = F.silu(self.qlora_w1(x)) * self.qlora_w3(x)
@@ -488,13 +604,28 @@ class QloraMLP(nn.Module):
 
 def swap_for_qlora(model: torch.nn.Module, qlora_config: QloraConfig, dtype) -> None:
     logging.info("Swapping for Qlora...")
-    for module in tqdm(model.layers):
+    # Convert every feed forward weight with one fused foreach copy instead of
+    # 3 * num_layers serial .to() kernels on the critical path of model init
+    source_weights = []
+    for module in model.layers:
         feed_forward = module.feed_forward
-        w1 = feed_forward.w1.weight.to(dtype=dtype)
-        w2 = feed_forward.w2.weight.to(dtype=dtype)
-        w3 = feed_forward.w3.weight.to(dtype=dtype)
-        new_mod = QloraMLP(w1, w2, w3, qlora_config)
-        module.feed_forward = new_mod
+        source_weights.extend(
+            (feed_forward.w1.weight, feed_forward.w2.weight, feed_forward.w3.weight)
+        )
+    # Weights already in the target dtype pass straight through: copying them
+    # too would transiently hold a second full set of MLP weights alive right
+    # at the init memory peak
+    converted_weights = list(source_weights)
+    mismatched = [i for i, weight in enumerate(source_weights) if weight.dtype != dtype]
+    if mismatched:
+        destinations = [torch.empty_like(source_weights[i], dtype=dtype) for i in mismatched]
+        torch._foreach_copy_(destinations, [source_weights[i] for i in mismatched])
+        for i, destination in zip(mismatched, destinations):
+            converted_weights[i] = destination
+
+    for i, module in enumerate(tqdm(model.layers)):
+        w1, w2, w3 = converted_weights[3 * i : 3 * i + 3]
+        module.feed_forward = QloraMLP(w1, w2, w3, qlora_config)
 
     for name, param in model.named_parameters():
         if "lora_" not in name:
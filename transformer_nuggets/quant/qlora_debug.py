@@ -1,7 +1,8 @@
 # A loop based (slow) implementation of the QLoRA weight
 import torch
 from scipy.stats import norm
-from tqdm import tqdm
+
+from transformer_nuggets.quant.qlora import _nf4, NF4Tensor
 
 
 class NF4TensorDebug:
@@ -10,26 +11,9 @@ class NF4TensorDebug:
     @staticmethod
     def get_nf4(cached=True) -> torch.Tensor:
         if cached:
-            return torch.tensor(
-                [
-                    -1.0000,
-                    -0.6962,
-                    -0.5251,
-                    -0.3949,
-                    -0.2844,
-                    -0.1848,
-                    -0.0911,
-                    0.0000,
-                    0.0796,
-                    0.1609,
-                    0.2461,
-                    0.3379,
-                    0.4407,
-                    0.5626,
-                    0.7230,
-                    1.0000,
-                ]
-            )
+            # Share the lru-cached table with NF4Tensor instead of rebuilding the
+            # 16 entries from a Python list on every call
+            return _nf4(torch.device("cpu"), torch.float32)
 
         offset = 0.9677083
         v1 = norm.ppf(torch.linspace(offset, 0.5, 9)[:-1]).tolist()
@@ -68,15 +52,9 @@ class NF4TensorDebug:
         return nkf[value]
 
     def get_scalers(self, inpt_tensor: torch.Tensor, block_size: int) -> torch.Tensor:
-        """Iterate through a flattened tensor getting the scalers for each block"""
-        flattened_tensor = inpt_tensor.flatten()
-        block_scalers = []
-        for block_start in range(0, inpt_tensor.numel(), block_size):
-            block_end = min(block_start + block_size, inpt_tensor.numel())
-            block = flattened_tensor[block_start:block_end]
-            block_max = block.abs().max()
-            block_scalers.append(block_max)
-        return torch.tensor(block_scalers)
+        """Get the absmax scalers for each block as one contiguous tensor"""
+        blocks = inpt_tensor.flatten().view(-1, block_size)
+        return blocks.abs().max(dim=1).values
 
     def __init__(self, inpt_tensor: torch.Tensor, block_size=64):
         assert inpt_tensor.dtype == torch.bfloat16
@@ -86,50 +64,44 @@ class NF4TensorDebug:
         self.block_size = block_size
         self.n_blocks = inpt_tensor.numel() // block_size
         self.scalers = self.get_scalers(inpt_tensor, self.block_size)
-        self.norm_float_weight = self.get_norm_float_weight(inpt_tensor.clone())
+        # get_norm_float_weight scales via an out-of-place divide, so no defensive
+        # clone of the input is needed
+        self.norm_float_weight = self.get_norm_float_weight(inpt_tensor)
         self.original_shape = inpt_tensor.shape
 
     def get_norm_float_weight(self, inpt_tensor: torch.Tensor) -> torch.Tensor:
-        nkf = self.get_nf4()
-        flattened_tensor = inpt_tensor.flatten()
+        nkf = self.get_nf4().to(inpt_tensor.device)
         #  Since we are using uint8 we will encode 2 entries per byte
         numel = inpt_tensor.numel()
         assert (
             numel % 2 == 0
         ), "Number of elements must be even just to not have to think about the end"
-        quantized_length = numel // 2
-        quantized_tensor = torch.zeros(quantized_length, dtype=torch.uint8)
-        for i in tqdm(range(len(self.scalers))):
-            block_start = i * self.block_size
-            block_end = min(block_start + self.block_size, flattened_tensor.numel())
-            block = flattened_tensor[block_start:block_end]
-            # Scale the block
-            block /= self.scalers[i]
-            # We will iterate over each element in the block and quantize it
-            # In groups of 2
-            for j in range(0, self.block_size, 2):
-                # Combine two bfloat16s via quantization to 4 bit types into a single uint8
-                element_1 = self.quantize_nearest(block[j], nkf)
-                element_2 = self.quantize_nearest(block[j + 1], nkf)
-                combined = element_1 << 4 | element_2
-                quantized_tensor[(i * self.block_size // 2) + j // 2] = combined
-        return quantized_tensor
+        # Scale each block by its absmax scaler
+        blocks = inpt_tensor.flatten().view(self.n_blocks, self.block_size)
+        scaled_blocks = blocks / self.scalers.to(inpt_tensor.device).unsqueeze(-1)
+        # Quantize all the blocks at once instead of element by element
+        quantized_blocks = NF4Tensor.quantize_tensor_nearest(scaled_blocks.flatten(), nkf)
+        # Combine two nf4 indices into a single uint8
+        combined_blocks = quantized_blocks[::2] << 4 | quantized_blocks[1::2]
+        return combined_blocks.to(torch.uint8)
 
     def get_original_weight(self):
         # since we are using uint8 we will decode 2 entries per byte
-        nkf = self.get_nf4()
-        original_weight = torch.empty(2 * (self.norm_float_weight.numel()), dtype=torch.bfloat16)
-        # Scalers is a proxy for num_blocks
-        for i in range(len(self.scalers)):
-            block_start = i * self.block_size
-            block_end = block_start + self.block_size
-            block = original_weight[block_start:block_end]
-            for j in range(0, self.block_size, 2):
-                combined = self.norm_float_weight[(i * self.block_size // 2) + j // 2]
-                # Shift element down 4
-                element_1 = combined >> 4
-                # Select out the bottom 4 bits
-                element_2 = combined & 0b1111
-                block[j] = self.dequantize(element_1.item(), nkf) * self.scalers[i]
-                block[j + 1] = self.dequantize(element_2.item(), nkf) * self.scalers[i]
+        device = self.norm_float_weight.device
+        nkf = self.get_nf4().to(device)
+        scalers = self.scalers.to(device).unsqueeze(-1)
+        # Shift elements down 4 and select out the bottom 4 bits
+        first_elements = (self.norm_float_weight >> 4).to(torch.long)
+        second_elements = (self.norm_float_weight & 0b1111).to(torch.long)
+        # Strided stores into the even/odd columns interleave the two nibbles of
+        # each byte without any per-element Python work
+        original_weight = torch.empty(
+            self.n_blocks, self.block_size, dtype=torch.bfloat16, device=device
+        )
+        original_weight[:, ::2] = (
+            self.dequantize(first_elements, nkf).view(self.n_blocks, -1) * scalers
+        )
+        original_weight[:, 1::2] = (
+            self.dequantize(second_elements, nkf).view(self.n_blocks, -1) * scalers
+        )
         return original_weight.reshape(self.original_shape)